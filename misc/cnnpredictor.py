@@ -16,7 +16,10 @@ class CnnPredictor(object):
             result_file: The file that saves the training results.
             k: Optional. Number of elements to be predicted.
         """
-        tf.train.import_meta_graph(os.path.join(result_dir, result_file + ".meta"))
+        # Clear the devices the model was trained on, e.g. its input pipeline on GPU, so
+        # that the model can be used on a CPU-only host as well.
+        tf.train.import_meta_graph(os.path.join(result_dir, result_file + ".meta"),
+                                   clear_devices=True)
         all_vars = tf.global_variables()
         model_vars = [var for var in all_vars if var.name.startswith(model_scope)]
         saver = tf.train.Saver(model_vars)
@@ -57,7 +57,10 @@ def freeze(model_scope, model_dir, model_file):
         model_dir: The full path to the folder in which the result file locates.
         model_file: The file that saves the training results, without file suffix / extension.
     """
-    saver = tf.train.import_meta_graph(os.path.join(model_dir, model_file + ".meta"))
+    # Clear the devices the model was trained on, so that the freezed model can be used on
+    # a CPU-only host as well.
+    saver = tf.train.import_meta_graph(os.path.join(model_dir, model_file + ".meta"),
+                                       clear_devices=True)
     graph = tf.get_default_graph()
     input_graph_def = graph.as_graph_def()
 
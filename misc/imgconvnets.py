@@ -5,6 +5,11 @@ import tensorflow as tf
 
 from misc.spatial_transformer import transformer
 
+# The adaptive learning rates, each used once the training accuracy (in percentage) of the
+# last epoch reaches the threshold at the same position.
+LR_ACCU_THRESHOLDS = np.array([99.92, 99.84, 99.76, 99.68, 99.60, 99.50, 99.00, 0.0])
+LR_VALUES = np.array([9.2e-5, 1e-4, 1.2e-4, 1.6e-4, 2e-4, 2.4e-4, 3.2e-4, 4e-4])
+
 
 class ImgConvNets(object):
     """
@@ -12,8 +17,15 @@ class ImgConvNets(object):
     for image recognition applications. All options require that image height and width
     are multiplications of 4.
     """
+    # The restored sessions and Ops used by predict, keyed by the model and k they serve.
+    _predictors = {}
+    # The sessions and Ops of the INT8 TensorRT engines built by build_int8_predictor, keyed
+    # by the model they are built from.
+    _int8_engines = {}
+
     def __init__(self, model, model_scope, img_height, img_width, class_count, keep_prob=0.5,
-                 learning_rate=1e-4, lr_adaptive=True, batch_size=32, num_epoches=100):
+                 learning_rate=1e-4, lr_adaptive=True, batch_size=32, num_epoches=100,
+                 precision='FP32', data_format='NHWC'):
         """
         Args:
             model: Specify which model to use.
@@ -29,8 +41,18 @@ class ImgConvNets(object):
             batch_size: optional. The number of samples to be used in one step of the
                 optimization process.
             num_epoches: optional. The number of epoches for the training process.
+            precision: optional. The precision used for the convolutional and fully connected
+                layers. With 'FP16', these layers compute in half precision (mixed precision
+                training), while the variables, the logits and the loss are kept in FP32. The
+                batch_size has to be a multiple of 8 then.
+            data_format: optional. The data format, 'NHWC' or 'NCHW', of the convolutional
+                layers. 'NCHW' may train faster on GPU in FP32, but TensorFlow cannot run it
+                on CPU, so the trained result can then only be used for prediction on GPU.
         """
         assert model == 'BASIC' or model == 'DCNN' or model == 'STCNN'
+        assert precision == 'FP32' or precision == 'FP16'
+        assert precision == 'FP32' or batch_size % 8 == 0
+        assert data_format == 'NHWC' or data_format == 'NCHW'
 
         self.model = model
         self.model_scope = model_scope
@@ -42,6 +64,8 @@ class ImgConvNets(object):
         self.lr_adaptive = lr_adaptive
         self.batch_size = batch_size
         self.num_epoches = num_epoches
+        self.precision = precision
+        self.data_format = data_format
 
     def train(self, img_features, true_labels, train_dir, result_file):
         """
@@ -60,14 +84,26 @@ class ImgConvNets(object):
         if cols != self.img_height * self.img_width:
             raise ValueError("Image feature dimension does not match the given "
                              "image size parameters")
+        if rows < self.batch_size:
+            raise ValueError("The training sample size is smaller than the batch size")
 
-        train_set = np.random.permutation(np.append(img_features, true_labels, axis=1))
+        gpu_available = tf.test.is_gpu_available(cuda_only=True)
 
         def_graph = tf.Graph()
         with def_graph.as_default():
             with tf.variable_scope(self.model_scope):
-                images_placeholder = tf.placeholder(tf.float32, name='images_placeholder')
-                labels_placeholder = tf.placeholder(tf.int32)
+                # The training set is fed only once, when the iterator is initialized, and the
+                # input pipeline prepares the batches in the background of the training steps.
+                # The labels are fed as int64, as the loss takes them, to save a cast per step.
+                features_placeholder = tf.placeholder(tf.float32, shape=[rows, cols])
+                true_labels_placeholder = tf.placeholder(tf.int64, shape=[rows])
+                iterator, images_batch, labels_batch = \
+                    self._build_input_pipeline(features_placeholder, true_labels_placeholder,
+                                               '/gpu:0' if gpu_available else None)
+
+                # Images are fed directly for prediction, and default to the input batch.
+                images_placeholder = tf.placeholder_with_default(
+                    images_batch, shape=[None, cols], name='images_placeholder')
 
                 keep_prob_placeholder = tf.placeholder(tf.float32, name='keep_prob_placeholder')
                 learning_rate_placeholder = tf.placeholder(tf.float32, shape=[])
@@ -82,7 +118,9 @@ class ImgConvNets(object):
 
                 # Add to the Graph the Ops that calculate and apply gradients.
                 train_op, loss, accuracy = \
-                    self._build_training_graph(logits, labels_placeholder, learning_rate_placeholder)
+                    self._build_training_graph(logits, labels_batch, learning_rate_placeholder)
+                update_stats_op, epoch_stats, reset_stats_op = \
+                    self._build_stats_graph(loss, accuracy)
 
             # Save the variables within the model_scope with given model_scope as prefix.
             tf.add_to_collection(self.model_scope+"images", images_placeholder)
@@ -93,38 +131,39 @@ class ImgConvNets(object):
             saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES,
                                                      scope=self.model_scope), max_to_keep=10)
 
-        with tf.Session(graph=def_graph) as sess:
+        with tf.Session(graph=def_graph, config=ImgConvNets._get_train_session_config()) as sess:
             sess.run(tf.global_variables_initializer())
+            sess.run(iterator.initializer,
+                     feed_dict={features_placeholder: img_features,
+                                true_labels_placeholder: np.reshape(true_labels, -1)})
 
-            # Start the training loop.
-            loss_list = []
-            accu_list = []
-            last_accu = 0.0
+            # Prepare the training step once as a callable, so that each step does not go
+            # through the fetch and feed handling of sess.run again.
+            train_step = sess.make_callable([train_op, update_stats_op],
+                                            feed_list=[learning_rate_placeholder,
+                                                       keep_prob_placeholder])
 
+            # Start the training loop.
             save_file = os.path.join(train_dir, result_file)
 
-            epoch_steps = math.ceil(train_set.shape[0] / self.batch_size)
+            # Each epoch runs full batches only, and the remaining samples are left out.
+            epoch_steps = rows // self.batch_size
+            last_accu = 0.0
+
             for epoch in range(1, self.num_epoches+1):
                 lr_feed = self._get_learning_rate(last_accu)
+                sess.run(reset_stats_op)
                 for step in range(epoch_steps):
-                    # Read a batch of images and labels
-                    batch_data = self._get_next_batch(train_set, step*self.batch_size)
-                    images_feed, labels_feed = \
-                        batch_data[:, :cols], batch_data[:, cols:].reshape(-1)
-
-                    # Run one step of the model.  The return values are the activations
-                    # from the `train_op` (which is discarded) and the `loss` Op.
-                    _, loss_val, accu_val = sess.run([train_op, loss, accuracy],
-                                                     feed_dict={images_placeholder: images_feed,
-                                                                labels_placeholder: labels_feed,
-                                                                learning_rate_placeholder: lr_feed,
-                                                                keep_prob_placeholder: self.keep_prob})
-
-                    # Check to make sure the loss is decreasing
-                    loss_list.append(loss_val)
-                    accu_list.append(accu_val)
-
-                mean_accu = sum(accu_list)*100/len(accu_list)
+                    # Run one step of the model on the next batch from the input pipeline. The
+                    # loss and accuracy of the step are accumulated in the graph, and are only
+                    # read back once the epoch completes.
+                    train_step(lr_feed, self.keep_prob)
+
+                # Check to make sure the loss is decreasing
+                mean_loss, min_accu, mean_accu, max_accu = sess.run(epoch_stats)
+                mean_accu = mean_accu*100
+                # Save synchronously: the variables are updated in place by the training steps,
+                # so a save running along with the next epoch would not hold this model.
                 if mean_accu >= 99.68 and mean_accu > last_accu:
                     saver.save(sess, save_file, global_step=epoch)
                 elif epoch == self.num_epoches - 1:
@@ -133,15 +172,45 @@ class ImgConvNets(object):
                 print("Epoch {:3d} completed: learning_rate used = {:.6f}, average loss = {:8.4f}, "
                       "and training accuracy min = {:6.2f}%, mean = {:6.2f}%, "
                       "max = {:6.2f}%".format(epoch, lr_feed,
-                                              sum(loss_list)/len(loss_list),
-                                              min(accu_list)*100, mean_accu,
-                                              max(accu_list)*100))
+                                              mean_loss, min_accu*100, mean_accu,
+                                              max_accu*100))
                 if mean_accu >= 99.99: break
 
-                loss_list = []
-                accu_list = []
                 last_accu = mean_accu
 
+    def _build_input_pipeline(self, features, true_labels, device=None):
+        """
+        Build the input pipeline which shuffles the training set for each epoch and batches it.
+        The samples left over from the last full batch of an epoch are dropped.
+        Args:
+            features: Tensor holding the features of all the training samples.
+            true_labels: Tensor holding the true labels of all the training samples.
+            device: optional. The device, e.g. '/gpu:0', to which the batches are copied
+                ahead of the training steps.
+        Returns:
+            iterator: The iterator to be initialized before the training starts.
+            images: Tensor with the images of the next batch, of batch_size rows.
+            labels: Tensor with the labels of the next batch, of batch_size rows.
+        """
+        rows = features.get_shape()[0].value
+
+        # Reshuffle the sample indices for each epoch. Each batch is then gathered from the
+        # training set, so that no shuffled copy of the whole training set is buffered.
+        dataset = tf.data.Dataset.range(rows)
+        dataset = dataset.shuffle(rows, reshuffle_each_iteration=True)
+        dataset = dataset.batch(self.batch_size, drop_remainder=True).repeat()
+        dataset = dataset.map(
+            lambda indices: (tf.gather(features, indices), tf.gather(true_labels, indices)))
+        if device is None:
+            dataset = dataset.prefetch(1)
+        else:
+            dataset = dataset.apply(tf.contrib.data.prefetch_to_device(device, buffer_size=2))
+
+        iterator = dataset.make_initializable_iterator()
+        images, labels = iterator.get_next()
+
+        return iterator, images, labels
+
     def _build_inference_graph_stcnn(self, images, keep_prob):
         """
         Build initial inference graph.
@@ -157,13 +226,18 @@ class ImgConvNets(object):
             shaped_images = tf.reshape(images, [-1, self.img_height, self.img_width, 1])
 
             # Define the two-layer localisation network, with a dropout layer
-            # after the first layer.
+            # after the first layer. The first layer is a strided convolution followed by
+            # a global average pooling, which needs far fewer parameters than a fully
+            # connected layer over all the pixels.
             num_batch = 64
 
-            W_fc_loc1 = tf.Variable(tf.zeros([self.img_height*self.img_width, num_batch]))
-            b_fc_loc1 = tf.Variable(
+            W_conv_loc1 = tf.Variable(tf.zeros([3, 3, 1, num_batch]))
+            b_conv_loc1 = tf.Variable(
                  tf.random_normal([num_batch], mean=0.0, stddev=0.01))
-            h_fc_loc1 = tf.nn.tanh(tf.matmul(images, W_fc_loc1) + b_fc_loc1)
+            h_conv_loc1 = tf.nn.tanh(tf.nn.bias_add(
+                tf.nn.conv2d(shaped_images, W_conv_loc1, strides=[1, 4, 4, 1], padding='SAME'),
+                b_conv_loc1))
+            h_fc_loc1 = tf.reduce_mean(h_conv_loc1, [1, 2])
 
             h_fc_loc1_drop = tf.nn.dropout(h_fc_loc1, keep_prob)
 
@@ -176,35 +250,40 @@ class ImgConvNets(object):
 
             # Create a spatial transformer module to identify discriminative patches
             out_size = (self.img_height, self.img_width)
-            h_trans = transformer(shaped_images, h_fc_loc2, out_size)
+            h_trans = self._shape_images(transformer(shaped_images, h_fc_loc2, out_size))
         # First Set of Convolutional Layers
         with tf.name_scope('conv1'):
             W_conv11 = tf.Variable(
-                tf.truncated_normal([3, 3, 1, 32], stddev=0.1), name='W_conv11')
+                tf.truncated_normal([3, 3, self._get_padded_count(1), 32], stddev=0.1),
+                name='W_conv11')
             b_conv11 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv11')
-            h_conv11 = tf.nn.relu(ImgConvNets._conv2d(h_trans, W_conv11) + b_conv11)
+            h_conv11 = tf.nn.relu(
+                ImgConvNets._conv2d(h_trans, W_conv11, b_conv11, self.data_format))
 
             W_conv12 = tf.Variable(
                 tf.truncated_normal([3, 3, 32, 32], stddev=0.1), name='W_conv12')
             b_conv12 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv12')
-            h_conv12 = tf.nn.relu(ImgConvNets._conv2d(h_conv11, W_conv12) + b_conv12)
+            h_conv12 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv11, W_conv12, b_conv12, self.data_format))
 
             # Output size: img_height/2 * img_width/2 * 32
-            h_pool1 = ImgConvNets._max_pool_2x2(h_conv12)
+            h_pool1 = ImgConvNets._max_pool_2x2(h_conv12, self.data_format)
         # Second Set of Convolutional Layers
         with tf.name_scope('conv2'):
             W_conv21 = tf.Variable(
                 tf.truncated_normal([3, 3, 32, 64], stddev=0.1), name='W_conv21')
             b_conv21 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv21')
-            h_conv21 = tf.nn.relu(ImgConvNets._conv2d(h_pool1, W_conv21) + b_conv21)
+            h_conv21 = tf.nn.relu(
+                ImgConvNets._conv2d(h_pool1, W_conv21, b_conv21, self.data_format))
 
             W_conv22 = tf.Variable(
                 tf.truncated_normal([3, 3, 64, 64], stddev=0.1), name='W_conv22')
             b_conv22 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv22')
-            h_conv22 = tf.nn.relu(ImgConvNets._conv2d(h_conv21, W_conv22) + b_conv22)
+            h_conv22 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv21, W_conv22, b_conv22, self.data_format))
 
             # Output size: img_height/4 * img_width/4 * 64
-            h_pool2 = ImgConvNets._max_pool_2x2(h_conv22)
+            h_pool2 = ImgConvNets._max_pool_2x2(h_conv22, self.data_format)
         # Fully Connected Layers
         with tf.name_scope("fully_connected"):
             para_cnt = int((self.img_height/4)*(self.img_width/4)*64)
@@ -212,16 +291,20 @@ class ImgConvNets(object):
             W_fc1 = tf.Variable(
                 tf.truncated_normal([para_cnt, 1024], stddev=0.1), name='W_fc1')
             b_fc1 = tf.Variable(tf.constant(0.1, shape=[1024]), name='b_fc1')
-            h_fc1 = tf.nn.relu(tf.matmul(h_pool2_flat, W_fc1) + b_fc1)
+            h_fc1 = tf.nn.relu(ImgConvNets._matmul(h_pool2_flat, W_fc1, b_fc1))
         # Dropout to reduce overfitting
         with tf.name_scope("dropout"):
-            h_fc1_drop = tf.nn.dropout(h_fc1, keep_prob)
+            h_fc1_drop = tf.nn.dropout(h_fc1, tf.cast(keep_prob, h_fc1.dtype))
         # Readout Layer
         with tf.name_scope('readout'):
             W_fc2 = tf.Variable(
-                tf.truncated_normal([1024, self.class_count], stddev=0.1), name='W_fc2')
+                tf.truncated_normal([1024, self._get_padded_count(self.class_count)], stddev=0.1),
+                name='W_fc2')
             b_fc2 = tf.Variable(tf.constant(0.1, shape=[self.class_count]), name='b_fc2')
-            logits = tf.add(tf.matmul(h_fc1_drop, W_fc2), b_fc2, name='logits')
+            # Produce the logits in FP32 so that softmax and the loss stay numerically stable.
+            # Any padded columns of the readout are dropped.
+            readout = tf.matmul(h_fc1_drop, tf.cast(W_fc2, h_fc1_drop.dtype))[:, :self.class_count]
+            logits = tf.add(tf.cast(readout, tf.float32), b_fc2, name='logits')
 
         return logits
 
@@ -237,54 +320,55 @@ class ImgConvNets(object):
         """
         # First Set of Convolutional Layers
         with tf.name_scope('conv1'):
-            shaped_images = tf.reshape(images, [-1, self.img_height, self.img_width, 1])
+            shaped_images = self._shape_images(images)
 
             W_conv11 = tf.Variable(
-                tf.truncated_normal([3, 3, 1, 32], stddev=0.1), name='W_conv11')
+                tf.truncated_normal([3, 3, self._get_padded_count(1), 32], stddev=0.1),
+                name='W_conv11')
             b_conv11 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv11')
-            h_conv11 = tf.nn.relu(ImgConvNets._conv2d(shaped_images, W_conv11) + b_conv11)
+            h_conv11 = tf.nn.relu(
+                ImgConvNets._conv2d(shaped_images, W_conv11, b_conv11, self.data_format))
 
-            W_conv12 = tf.Variable(
-                tf.truncated_normal([1, 3, 32, 32], stddev=0.1), name='W_conv12')
+            W_depth12 = tf.Variable(
+                tf.truncated_normal([3, 3, 32, 1], stddev=0.1), name='W_depth12')
+            W_point12 = tf.Variable(
+                tf.truncated_normal([1, 1, 32, 32], stddev=0.1), name='W_point12')
             b_conv12 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv12')
-            h_conv12 = tf.nn.relu(ImgConvNets._conv2d(h_conv11, W_conv12)+ b_conv12)
+            h_conv12 = tf.nn.relu(ImgConvNets._separable_conv2d(
+                h_conv11, W_depth12, W_point12, b_conv12, self.data_format))
 
             W_conv13 = tf.Variable(
-                tf.truncated_normal([3, 1, 32, 32], stddev=0.1), name='W_conv13')
+                tf.truncated_normal([3, 3, 32, 32], stddev=0.1), name='W_conv13')
             b_conv13 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv13')
-            h_conv13 = tf.nn.relu(ImgConvNets._conv2d(h_conv12, W_conv13) + b_conv13)
-
-            W_conv14 = tf.Variable(
-                tf.truncated_normal([3, 3, 32, 32], stddev=0.1), name='W_conv14')
-            b_conv14 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv14')
-            h_conv14 = tf.nn.relu(ImgConvNets._conv2d(h_conv13, W_conv14) + b_conv14)
+            h_conv13 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv12, W_conv13, b_conv13, self.data_format))
 
             # Output size: img_height/2 * img_width/2 * 32
-            h_pool1 = ImgConvNets._max_pool_2x2(h_conv14)
+            h_pool1 = ImgConvNets._max_pool_2x2(h_conv13, self.data_format)
         # Second Set of Convolutional Layers
         with tf.name_scope('conv2'):
             W_conv21 = tf.Variable(
                 tf.truncated_normal([3, 3, 32, 64], stddev=0.1), name='W_conv21')
             b_conv21 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv21')
-            h_conv21 = tf.nn.relu(ImgConvNets._conv2d(h_pool1, W_conv21) + b_conv21)
+            h_conv21 = tf.nn.relu(
+                ImgConvNets._conv2d(h_pool1, W_conv21, b_conv21, self.data_format))
 
-            W_conv22 = tf.Variable(
-                tf.truncated_normal([1, 3, 64, 64], stddev=0.1), name='W_conv22')
+            W_depth22 = tf.Variable(
+                tf.truncated_normal([3, 3, 64, 1], stddev=0.1), name='W_depth22')
+            W_point22 = tf.Variable(
+                tf.truncated_normal([1, 1, 64, 64], stddev=0.1), name='W_point22')
             b_conv22 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv22')
-            h_conv22 = tf.nn.relu(ImgConvNets._conv2d(h_conv21, W_conv22) + b_conv22)
+            h_conv22 = tf.nn.relu(ImgConvNets._separable_conv2d(
+                h_conv21, W_depth22, W_point22, b_conv22, self.data_format))
 
             W_conv23 = tf.Variable(
-                tf.truncated_normal([3, 1, 64, 64], stddev=0.1), name='W_conv23')
+                tf.truncated_normal([3, 3, 64, 64], stddev=0.1), name='W_conv23')
             b_conv23 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv23')
-            h_conv23 = tf.nn.relu(ImgConvNets._conv2d(h_conv22, W_conv23) + b_conv23)
-
-            W_conv24 = tf.Variable(
-                tf.truncated_normal([3, 3, 64, 64], stddev=0.1), name='W_conv24')
-            b_conv24 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv24')
-            h_conv24 = tf.nn.relu(ImgConvNets._conv2d(h_conv23, W_conv24) + b_conv24)
+            h_conv23 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv22, W_conv23, b_conv23, self.data_format))
 
             # Output size: img_height/4 * img_width/4 * 64
-            h_pool2 = ImgConvNets._max_pool_2x2(h_conv24)
+            h_pool2 = ImgConvNets._max_pool_2x2(h_conv23, self.data_format)
         # Fully Connected Layers
         with tf.name_scope("fully_connected"):
             para_cnt = int((self.img_height/4)*(self.img_width/4)*64)
@@ -292,21 +376,25 @@ class ImgConvNets(object):
             W_fc1 = tf.Variable(
                 tf.truncated_normal([para_cnt, 1024], stddev=0.1), name='W_fc1')
             b_fc1 = tf.Variable(tf.constant(0.1, shape=[1024]), name='b_fc1')
-            h_fc1 = tf.nn.relu(tf.matmul(h_pool2_flat, W_fc1) + b_fc1)
+            h_fc1 = tf.nn.relu(ImgConvNets._matmul(h_pool2_flat, W_fc1, b_fc1))
 
             W_fc2 = tf.Variable(
                 tf.truncated_normal([1024, 1024], stddev=0.1), name='W_fc2')
             b_fc2 = tf.Variable(tf.constant(0.1, shape=[1024]), name='b_fc2')
-            h_fc2 = tf.nn.relu(tf.matmul(h_fc1, W_fc2) + b_fc2)
+            h_fc2 = tf.nn.relu(ImgConvNets._matmul(h_fc1, W_fc2, b_fc2))
         # Dropout to reduce overfitting
         with tf.name_scope("dropout"):
-            h_fc2_drop = tf.nn.dropout(h_fc2, keep_prob)
+            h_fc2_drop = tf.nn.dropout(h_fc2, tf.cast(keep_prob, h_fc2.dtype))
         # Readout Layer
         with tf.name_scope('readout'):
             W_fc3 = tf.Variable(
-                tf.truncated_normal([1024, self.class_count], stddev=0.1), name='W_fc3')
+                tf.truncated_normal([1024, self._get_padded_count(self.class_count)], stddev=0.1),
+                name='W_fc3')
             b_fc3 = tf.Variable(tf.constant(0.1, shape=[self.class_count]), name='b_fc3')
-            logits = tf.add(tf.matmul(h_fc2_drop, W_fc3), b_fc3, name='logits')
+            # Produce the logits in FP32 so that softmax and the loss stay numerically stable.
+            # Any padded columns of the readout are dropped.
+            readout = tf.matmul(h_fc2_drop, tf.cast(W_fc3, h_fc2_drop.dtype))[:, :self.class_count]
+            logits = tf.add(tf.cast(readout, tf.float32), b_fc3, name='logits')
 
         return logits
 
@@ -322,34 +410,39 @@ class ImgConvNets(object):
         """
         # First Set of Convolutional Layers
         with tf.name_scope('conv1'):
-            shaped_images = tf.reshape(images, [-1, self.img_height, self.img_width, 1])
+            shaped_images = self._shape_images(images)
 
             W_conv11 = tf.Variable(
-                tf.truncated_normal([3, 3, 1, 32], stddev=0.1), name='W_conv11')
+                tf.truncated_normal([3, 3, self._get_padded_count(1), 32], stddev=0.1),
+                name='W_conv11')
             b_conv11 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv11')
-            h_conv11 = tf.nn.relu(ImgConvNets._conv2d(shaped_images, W_conv11) + b_conv11)
+            h_conv11 = tf.nn.relu(
+                ImgConvNets._conv2d(shaped_images, W_conv11, b_conv11, self.data_format))
 
             W_conv12 = tf.Variable(
                 tf.truncated_normal([3, 3, 32, 32], stddev=0.1), name='W_conv12')
             b_conv12 = tf.Variable(tf.constant(0.1, shape=[32]), name='b_conv12')
-            h_conv12 = tf.nn.relu(ImgConvNets._conv2d(h_conv11, W_conv12) + b_conv12)
+            h_conv12 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv11, W_conv12, b_conv12, self.data_format))
 
             # Output size: img_height/2 * img_width/2 * 32
-            h_pool1 = ImgConvNets._max_pool_2x2(h_conv12)
+            h_pool1 = ImgConvNets._max_pool_2x2(h_conv12, self.data_format)
         # Second Set of Convolutional Layers
         with tf.name_scope('conv2'):
             W_conv21 = tf.Variable(
                 tf.truncated_normal([3, 3, 32, 64], stddev=0.1), name='W_conv21')
             b_conv21 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv21')
-            h_conv21 = tf.nn.relu(ImgConvNets._conv2d(h_pool1, W_conv21) + b_conv21)
+            h_conv21 = tf.nn.relu(
+                ImgConvNets._conv2d(h_pool1, W_conv21, b_conv21, self.data_format))
 
             W_conv22 = tf.Variable(
                 tf.truncated_normal([3, 3, 64, 64], stddev=0.1), name='W_conv22')
             b_conv22 = tf.Variable(tf.constant(0.1, shape=[64]), name='b_conv22')
-            h_conv22 = tf.nn.relu(ImgConvNets._conv2d(h_conv21, W_conv22) + b_conv22)
+            h_conv22 = tf.nn.relu(
+                ImgConvNets._conv2d(h_conv21, W_conv22, b_conv22, self.data_format))
 
             # Output size: img_height/4 * img_width/4 * 64
-            h_pool2 = ImgConvNets._max_pool_2x2(h_conv22)
+            h_pool2 = ImgConvNets._max_pool_2x2(h_conv22, self.data_format)
         # Fully Connected Layers
         with tf.name_scope("fully_connected"):
             para_cnt = int((self.img_height/4)*(self.img_width/4)*64)
@@ -357,16 +450,20 @@ class ImgConvNets(object):
             W_fc1 = tf.Variable(
                 tf.truncated_normal([para_cnt, 1024], stddev=0.1), name='W_fc1')
             b_fc1 = tf.Variable(tf.constant(0.1, shape=[1024]), name='b_fc1')
-            h_fc1 = tf.nn.relu(tf.matmul(h_pool2_flat, W_fc1) + b_fc1)
+            h_fc1 = tf.nn.relu(ImgConvNets._matmul(h_pool2_flat, W_fc1, b_fc1))
         # Dropout to reduce overfitting
         with tf.name_scope("dropout"):
-            h_fc1_drop = tf.nn.dropout(h_fc1, keep_prob)
+            h_fc1_drop = tf.nn.dropout(h_fc1, tf.cast(keep_prob, h_fc1.dtype))
         # Readout Layer
         with tf.name_scope('readout'):
             W_fc2 = tf.Variable(
-                tf.truncated_normal([1024, self.class_count], stddev=0.1), name='W_fc2')
+                tf.truncated_normal([1024, self._get_padded_count(self.class_count)], stddev=0.1),
+                name='W_fc2')
             b_fc2 = tf.Variable(tf.constant(0.1, shape=[self.class_count]), name='b_fc2')
-            logits = tf.add(tf.matmul(h_fc1_drop, W_fc2), b_fc2, name='logits')
+            # Produce the logits in FP32 so that softmax and the loss stay numerically stable.
+            # Any padded columns of the readout are dropped.
+            readout = tf.matmul(h_fc1_drop, tf.cast(W_fc2, h_fc1_drop.dtype))[:, :self.class_count]
+            logits = tf.add(tf.cast(readout, tf.float32), b_fc2, name='logits')
 
         return logits
 
@@ -375,7 +472,7 @@ class ImgConvNets(object):
         Build the training graph.
         Args:
             logits: Logits tensor, float - [batch_size, class_count].
-            labels: Labels tensor, int32 - [batch_size], with values in the range
+            labels: Labels tensor, int32 or int64 - [batch_size], with values in the range
                 [0, class_count).
             learning_rate: The learning rate for the optimization.
         Returns:
@@ -387,50 +484,102 @@ class ImgConvNets(object):
         cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
             logits=logits, labels=labels, name='xentropy')
         loss = tf.reduce_mean(cross_entropy, name='xentropy_mean')
-        train_op = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        if self.precision == 'FP16':
+            # Scale the loss dynamically so that small gradients do not underflow in FP16.
+            loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                init_loss_scale=2**15, incr_every_n_steps=2000)
+            optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, loss_scale_manager)
+        train_op = optimizer.minimize(loss)
 
         correct_predict = tf.nn.in_top_k(logits, labels, 1)
         accuracy = tf.reduce_mean(tf.cast(correct_predict, tf.float32))
 
         return train_op, loss, accuracy
 
-    def _get_next_batch(self, data_set, start_index):
-        cnt = data_set.shape[0]
-
-        start = start_index
-        if start >= cnt:
-            start = start_index % cnt
-
-        end = start + self.batch_size
-        if end < cnt:
-            return data_set[start:end]
-        else:
-            end = end % cnt
-            return np.concatenate((data_set[start:], data_set[:end]))
+    def _build_stats_graph(self, loss, accuracy):
+        """
+        Build the Ops that accumulate the loss and accuracy of the training steps within the
+        graph, so that they need not be read back after every step.
+        Args:
+            loss: The Op for calculating loss.
+            accuracy: The Op for calculating accuracy.
+        Returns:
+            update_op: The Op to be run along with each training step.
+            stats: Tensors of the mean loss, and the min, mean and max accuracy, of the
+                steps run since the last reset.
+            reset_op: The Op to clear the accumulated values.
+        """
+        def _local_variable(initial_value):
+            # Local variables are neither saved with the model, nor trained.
+            return tf.Variable(initial_value, trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        step_cnt = _local_variable(0.0)
+        loss_sum = _local_variable(0.0)
+        accu_sum = _local_variable(0.0)
+        accu_min = _local_variable(np.inf)
+        accu_max = _local_variable(-np.inf)
+
+        update_op = tf.group(tf.assign_add(step_cnt, 1.0),
+                             tf.assign_add(loss_sum, loss),
+                             tf.assign_add(accu_sum, accuracy),
+                             tf.assign(accu_min, tf.minimum(accu_min, accuracy)),
+                             tf.assign(accu_max, tf.maximum(accu_max, accuracy)))
+        stats = (loss_sum / step_cnt, accu_min, accu_sum / step_cnt, accu_max)
+        reset_op = tf.variables_initializer([step_cnt, loss_sum, accu_sum, accu_min, accu_max])
+
+        return update_op, stats, reset_op
 
     def _get_learning_rate(self, last_accu):
         if not self.lr_adaptive:
             return self.learning_rate
-        elif last_accu >= 99.92:
-            return 9.2e-5
-        elif last_accu >= 99.84:
-            return 1e-4
-        elif last_accu >= 99.76:
-            return 1.2e-4
-        elif last_accu >= 99.68:
-            return 1.6e-4
-        elif last_accu >= 99.60:
-            return 2e-4
-        elif last_accu >= 99.50:
-            return 2.4e-4
-        elif last_accu >= 99.00:
-            return 3.2e-4
+
+        # The thresholds are in descending order, so search the first one not above
+        # last_accu in their negated (ascending) order.
+        idx = np.searchsorted(-LR_ACCU_THRESHOLDS, -last_accu)
+        return float(LR_VALUES[min(idx, len(LR_VALUES) - 1)])
+
+    def _shape_images(self, images):
+        if self.data_format == 'NCHW':
+            shape = [-1, 1, self.img_height, self.img_width]
+        else:
+            shape = [-1, self.img_height, self.img_width, 1]
+        shaped_images = tf.cast(tf.reshape(images, shape), self._get_compute_dtype())
+
+        # Zero pad the single channel of the images to the padded channel count.
+        padding = self._get_padded_count(1) - 1
+        if padding > 0:
+            if self.data_format == 'NCHW':
+                paddings = [[0, 0], [0, padding], [0, 0], [0, 0]]
+            else:
+                paddings = [[0, 0], [0, 0], [0, 0], [0, padding]]
+            shaped_images = tf.pad(shaped_images, paddings)
+
+        return shaped_images
+
+    def _get_padded_count(self, count):
+        # Tensor Cores only run the half precision convolutions and matmuls whose channel
+        # and output counts are multiples of 8.
+        if self.precision == 'FP32':
+            return count
+        else:
+            return int(math.ceil(count / 8)) * 8
+
+    def _get_compute_dtype(self):
+        if self.precision == 'FP16':
+            return tf.float16
         else:
-            return 4e-4
+            return tf.float32
 
-    @staticmethod
-    def predict(model_scope, result_dir, result_file, img_features, k=1):
+    @classmethod
+    def predict(cls, model_scope, result_dir, result_file, img_features, k=1, int8=False):
         """
+        The trained result is restored on the first call only. Later calls with the same
+        model_scope, result_dir, result_file, k and int8 reuse the restored session. The
+        devices the model was trained on are cleared, so that a model trained on GPU can
+        also be used for prediction on CPU.
         Args:
             model_scope: The variable_scope used when this model was trained.
             result_dir: The full path to the folder in which the result file locates.
@@ -439,11 +588,72 @@ class ImgConvNets(object):
                 features of one image. One or more rows (image samples) can be requested
                 to be predicted at once.
             k: Optional. Number of elements to be predicted.
+            int8: Optional. Whether to predict with the INT8 TensorRT engine built for this
+                model by build_int8_predictor, which must be called first. The img_features
+                must then have no more rows than the max_batch_size of the engine.
         Returns:
             values and indices. Refer to tf.nn.top_k for details.
         """
-        with tf.Session(graph=tf.Graph()) as sess:
-            saver = tf.train.import_meta_graph(os.path.join(result_dir, result_file + ".meta"))
+        key = (model_scope, result_dir, result_file, k, int8)
+        if key not in cls._predictors:
+            if int8:
+                cls._predictors[key] = cls._add_int8_top_k(model_scope, result_dir,
+                                                           result_file, k)
+            else:
+                cls._predictors[key] = cls._restore_predictor(
+                    model_scope, result_dir, result_file, k)
+        sess, images_placeholder, keep_prob_placeholder, eval_op = cls._predictors[key]
+
+        values, indices = sess.run(eval_op, feed_dict={images_placeholder: img_features,
+                                                       keep_prob_placeholder: 1.0})
+
+        return values, indices
+
+    @classmethod
+    def build_int8_predictor(cls, model_scope, result_dir, result_file, calib_features,
+                             max_batch_size):
+        """
+        Build a TensorRT engine quantized to INT8 from the trained result, for predict to use
+        with int8=True. This requires TensorFlow built with TensorRT. The engine is built and
+        calibrated once per model; building it again replaces the previous one.
+        Args:
+            model_scope: The variable_scope used when this model was trained.
+            result_dir: The full path to the folder in which the result file locates.
+            result_file: The file that saves the training results.
+            calib_features: A 2-D ndarray (matrix) of images representative of the ones to be
+                predicted, in the same layout as the img_features of predict. They are run
+                through the model in batches of max_batch_size to calibrate the quantization.
+            max_batch_size: The largest number of rows predict can be called with.
+        """
+        model_key = (model_scope, result_dir, result_file)
+        if model_key in cls._int8_engines:
+            cls._int8_engines.pop(model_key)[0].close()
+            for key in [key for key in cls._predictors if key[:3] == model_key and key[4]]:
+                del cls._predictors[key]
+
+        cls._int8_engines[model_key] = cls._restore_trt_int8_engine(
+            model_scope, result_dir, result_file, calib_features, max_batch_size)
+
+    @classmethod
+    def close_predictors(cls):
+        """
+        Close all the sessions restored by predict and built by build_int8_predictor, e.g.
+        after the models are retrained.
+        """
+        for sess, _, _, _ in cls._predictors.values():
+            sess.close()
+        for sess, _, _, _ in cls._int8_engines.values():
+            sess.close()
+        cls._predictors.clear()
+        cls._int8_engines.clear()
+
+    @classmethod
+    def _restore_predictor(cls, model_scope, result_dir, result_file, k):
+        graph = tf.Graph()
+        with graph.as_default():
+            saver = tf.train.import_meta_graph(os.path.join(result_dir, result_file + ".meta"),
+                                               clear_devices=True)
+            sess = tf.Session(graph=graph, config=cls._get_predict_session_config())
             saver.restore(sess, os.path.join(result_dir, result_file))
 
             # Retrieve the Ops we 'remembered'.
@@ -455,16 +665,111 @@ class ImgConvNets(object):
             # we can have the probabilities (percentage) in the output.
             eval_op = tf.nn.top_k(tf.nn.softmax(logits), k=k)
 
-            values, indices = sess.run(eval_op, feed_dict={images_placeholder: img_features,
-                                                           keep_prob_placeholder: 1.0})
+        return sess, images_placeholder, keep_prob_placeholder, eval_op
+
+    @classmethod
+    def _add_int8_top_k(cls, model_scope, result_dir, result_file, k):
+        model_key = (model_scope, result_dir, result_file)
+        if model_key not in cls._int8_engines:
+            raise ValueError("No INT8 engine is built for {}. Call build_int8_predictor "
+                             "first.".format(os.path.join(result_dir, result_file)))
+        sess, images_placeholder, keep_prob_placeholder, logits = cls._int8_engines[model_key]
+
+        # All the k share the calibrated engine, with their own top k Op on top of it.
+        with sess.graph.as_default():
+            eval_op = tf.nn.top_k(tf.nn.softmax(logits), k=k)
 
-            return values, indices
+        return sess, images_placeholder, keep_prob_placeholder, eval_op
+
+    @classmethod
+    def _restore_trt_int8_engine(cls, model_scope, result_dir, result_file, calib_features,
+                                 max_batch_size):
+        from tensorflow.contrib import tensorrt as trt
+
+        # Freeze the trained result into a graph holding the logits and what they depend on.
+        graph = tf.Graph()
+        with graph.as_default():
+            saver = tf.train.import_meta_graph(os.path.join(result_dir, result_file + ".meta"),
+                                               clear_devices=True)
+            with tf.Session(graph=graph, config=cls._get_predict_session_config()) as sess:
+                saver.restore(sess, os.path.join(result_dir, result_file))
+
+                logits = tf.get_collection(model_scope+"logits")[0]
+                images_placeholder = tf.get_collection(model_scope+"images")[0]
+                keep_prob_placeholder = tf.get_collection(model_scope+"keep_prob")[0]
+
+                frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+                    sess, graph.as_graph_def(), [logits.op.name])
+        tensor_names = [logits.name, images_placeholder.name, keep_prob_placeholder.name]
+
+        # Replace the supported Ops with TensorRT engines, and calibrate their INT8
+        # quantization by running the given images through them.
+        calib_graph_def = trt.create_inference_graph(
+            input_graph_def=frozen_graph_def, outputs=[logits.op.name],
+            max_batch_size=max_batch_size, max_workspace_size_bytes=1 << 28,
+            precision_mode='INT8')
+
+        calib_graph = tf.Graph()
+        with calib_graph.as_default():
+            logits, images_placeholder, keep_prob_placeholder = tf.import_graph_def(
+                calib_graph_def, return_elements=tensor_names, name='')
+            with tf.Session(graph=calib_graph, config=cls._get_predict_session_config()) as sess:
+                for start in range(0, calib_features.shape[0], max_batch_size):
+                    sess.run(logits, feed_dict={
+                        images_placeholder: calib_features[start:start + max_batch_size],
+                        keep_prob_placeholder: 1.0})
+
+        infer_graph_def = trt.calib_graph_to_infer_graph(calib_graph_def)
+
+        graph = tf.Graph()
+        with graph.as_default():
+            logits, images_placeholder, keep_prob_placeholder = tf.import_graph_def(
+                infer_graph_def, return_elements=tensor_names, name='')
+            sess = tf.Session(graph=graph, config=cls._get_predict_session_config())
+
+        return sess, images_placeholder, keep_prob_placeholder, logits
+
+    @classmethod
+    def _get_train_session_config(cls):
+        # Let XLA compile clusters of the small ops (e.g. conv, bias, relu and pooling, or the
+        # localisation network of the transformer) into fused kernels. This is for training
+        # only, where the batch shape is fixed: XLA compiles again for each new batch shape,
+        # which would be paid by the predictions of varying row numbers.
+        config = tf.ConfigProto()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        return config
 
     @classmethod
-    def _conv2d(cls, X, W):
-        return tf.nn.conv2d(X, W, strides=[1, 1, 1, 1], padding='SAME')
+    def _get_predict_session_config(cls):
+        # A model trained on GPU holds its input pipeline on the GPU. Let any Op still bound
+        # to a device that is not available run elsewhere, e.g. when predicting on CPU.
+        return tf.ConfigProto(allow_soft_placement=True)
 
     @classmethod
-    def _max_pool_2x2(cls, X):
-        return tf.nn.max_pool(X, ksize=[1, 2, 2, 1],
-                              strides=[1, 2, 2, 1], padding='SAME')
\ No newline at end of file
+    def _conv2d(cls, X, W, b, data_format):
+        # Variables are kept in FP32, and cast to the compute precision of X when used.
+        # BiasAdd (rather than Add) lets the following Relu be fused into the convolution.
+        conv = tf.nn.conv2d(X, tf.cast(W, X.dtype), strides=[1, 1, 1, 1], padding='SAME',
+                            data_format=data_format)
+        return tf.nn.bias_add(conv, tf.cast(b, X.dtype), data_format=data_format)
+
+    @classmethod
+    def _separable_conv2d(cls, X, W_depthwise, W_pointwise, b, data_format):
+        conv = tf.nn.separable_conv2d(X, tf.cast(W_depthwise, X.dtype),
+                                      tf.cast(W_pointwise, X.dtype), strides=[1, 1, 1, 1],
+                                      padding='SAME', data_format=data_format)
+        return tf.nn.bias_add(conv, tf.cast(b, X.dtype), data_format=data_format)
+
+    @classmethod
+    def _matmul(cls, X, W, b):
+        return tf.nn.bias_add(tf.matmul(X, tf.cast(W, X.dtype)), tf.cast(b, X.dtype))
+
+    @classmethod
+    def _max_pool_2x2(cls, X, data_format):
+        if data_format == 'NCHW':
+            window = [1, 1, 2, 2]
+        else:
+            window = [1, 2, 2, 1]
+
+        return tf.nn.max_pool(X, ksize=window, strides=window, padding='SAME',
+                              data_format=data_format)
\ No newline at end of file